@@ -1,24 +1,53 @@
 # main.py
-import os, requests
+# gevent must patch the stdlib BEFORE anything else imports socket/ssl,
+# so that requests calls inside NotionManager become non-blocking under
+# the gevent gunicorn worker (concurrent webhooks no longer serialize on
+# Notion round-trips).
+from gevent import monkey
+monkey.patch_all()
+
+import os, hashlib, logging, requests
+import orjson
 from flask import Flask, request
+from flask_orjson import OrjsonProvider
 from telebot import types
 from dotenv import load_dotenv
 from telegram_manager import BotManager   # your class defined ONLY in telegram_manager.py
 
 load_dotenv()
 
+# debug lines cost nothing at the default INFO level: %s formatting is lazy,
+# so the (non-trivial) Update repr is never built unless LOG_LEVEL=DEBUG
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+log = logging.getLogger(__name__)
+
+# BOT_MODE=polling skips the webhook + Flask layer entirely and pulls updates
+# with infinity_polling instead — handy for a single-bot deployment with no
+# public HTTPS endpoint (no ngrok, no WSGI overhead per update)
+BOT_MODE = os.getenv("BOT_MODE", "webhook")
+
 WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # e.g. https://3a44d98a8670.ngrok-free.app/webhook
-assert WEBHOOK_URL and WEBHOOK_URL.startswith("https://") and WEBHOOK_URL.endswith("/webhook")
+
+# Telegram echoes this back in the X-Telegram-Bot-Api-Secret-Token header, so
+# anyone else POSTing to /webhook is rejected before we pay for JSON parsing.
+# Defaults to a hash of the bot token so no extra env var is required.
+TG_SECRET = os.environ.get("TG_SECRET") or hashlib.sha256(
+    (os.getenv("BOT_TOKEN") or os.getenv("TELEGRAM_BOT_TOKEN") or "").encode()
+).hexdigest()
 
 bot = BotManager().bot
 app = Flask(__name__)
+app.json = OrjsonProvider(app)  # orjson (Rust) instead of stdlib json for Flask's JSON handling
 
-# set webhook
-bot.remove_webhook()
-bot.set_webhook(
-    url=WEBHOOK_URL,
-    allowed_updates=["message", "callback_query"],
-)
+if BOT_MODE != "polling":
+    assert WEBHOOK_URL and WEBHOOK_URL.startswith("https://") and WEBHOOK_URL.endswith("/webhook")
+    # set webhook
+    bot.remove_webhook()
+    bot.set_webhook(
+        url=WEBHOOK_URL,
+        allowed_updates=["message", "callback_query"],
+        secret_token=TG_SECRET,
+    )
 
 @app.route("/", methods=["GET"])
 def home():
@@ -26,21 +55,27 @@ def home():
 
 @app.route("/webhook", methods=["POST"])
 def webhook():
+    # cheap header compare first — bogus requests never reach the JSON parser
+    if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != TG_SECRET:
+        return "", 401
     if not request.is_json:
         return "invalid", 403
-    update = types.Update.de_json(request.get_json())  # dict → Update
+    update = types.Update.de_json(orjson.loads(request.get_data()))  # bytes → dict → Update
     if getattr(update, "callback_query", None):
-        print("Webhook received callback_query")
+        log.debug("Webhook received callback_query")
     elif getattr(update, "message", None):
-        print("Webhook received message")
+        log.debug("Webhook received message")
     bot.process_new_updates([update])
-    # REMOVE THE FOLLOWING PRINT STATEMENT TO REMOVE THE UPDATE JSON printed.
-    print(update)
+    log.debug("update %s", update)
     return "", 200
 
 if __name__ == "__main__":
-    token = os.getenv("BOT_TOKEN") or os.getenv("TELEGRAM_BOT_TOKEN")
-    print("getWebhookInfo:", requests.get(
-        f"https://api.telegram.org/bot{token}/getWebhookInfo"
-    ).json())
-    app.run(host="0.0.0.0", port=int(os.getenv("PORT", "5001")))
+    if BOT_MODE == "polling":
+        bot.remove_webhook()  # Telegram rejects getUpdates while a webhook is set
+        bot.infinity_polling(allowed_updates=["message", "callback_query"])
+    else:
+        token = os.getenv("BOT_TOKEN") or os.getenv("TELEGRAM_BOT_TOKEN")
+        log.info("getWebhookInfo: %s", orjson.loads(requests.get(
+            f"https://api.telegram.org/bot{token}/getWebhookInfo"
+        ).content))
+        app.run(host="0.0.0.0", port=int(os.getenv("PORT", "5001")))
@@ -1,5 +1,6 @@
 # telegram_manager.py
-import os, html, secrets
+import os, hmac, hashlib, base64, logging, uuid
+from collections import deque
 from dotenv import load_dotenv, find_dotenv
 from telebot import TeleBot, types
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
@@ -7,23 +8,47 @@ from notion_manager import NotionManager
 
 load_dotenv(find_dotenv(), override=True)
 
+log = logging.getLogger(__name__)
+
 TOKEN = os.environ.get("BOT_TOKEN") or os.environ.get("TELEGRAM_BOT_TOKEN")
 if not TOKEN:
     raise RuntimeError("Missing BOT_TOKEN / TELEGRAM_BOT_TOKEN")
 
+# secret used to sign callback tokens; falls back to the bot token (already secret)
+CB_SECRET = (os.environ.get("CB_SECRET") or TOKEN).encode()
+
+# sentinel packed in place of an expense-type id for the 🗑 Delete button
+_DELETE_SENTINEL = b"\x00" * 16
+
+# single-pass HTML escaping: html.escape does several str.replace passes and
+# a fresh allocation each; one str.translate with a precomputed table is one
+# pass and one allocation, which adds up at 3 escaped fields × 50 records
+_HTML = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"})
+
 notion_bot = NotionManager()
 
+# records per "page" of the digest's number-picker keyboard
+PICKER_PAGE_SIZE = 10
+
 class BotManager:
     def __init__(self):
         # ⭐(Q1) parse_mode="HTML" lets us use <b>, <i>, <a href=...> etc. for nicer messages.
-        self.bot = TeleBot(token=TOKEN, parse_mode="HTML")
+        # num_threads sizes the handler worker pool used in polling mode.
+        self.bot = TeleBot(token=TOKEN, parse_mode="HTML", num_threads=4)
+
+        # ⭐(Q6) keep track of message ids we sent per chat so we can delete/clean on next /search.
+        # deque(maxlen=200) so swallowed delete failures can't grow this without
+        # bound — old ids age out, keeping memory at O(chats × 200) worst case
+        self.user_messages: dict[int, deque[int]] = {}
 
-        # ⭐(Q6) keep track of message ids we sent per chat so we can delete/clean on next /search
-        self.user_messages: dict[int, list[int]] = {}
+        # the category list is static for a bot session → filter the unset env
+        # ids once here instead of re-walking the dict for every record's keyboard
+        self._categories = [(name, exp_id) for name, exp_id in notion_bot.expense_type_ids.items() if exp_id]
 
-        # ⭐(Q2) callback map: short key → (txn_page_id, expense_type_page_id)
-        # Reason: Telegram callback_data must be ≤ 64 bytes; two Notion IDs won't fit.
-        self.callback_map: dict[str, tuple[str, str]] = {}
+        # one digest message per chat instead of one message per record:
+        # the current /search batch lives here so the picker callbacks know
+        # which record each number refers to
+        self.search_sessions: dict[int, dict] = {}
 
         # ── Handlers ──
         self.bot.message_handler(commands=['start'])(self.start)
@@ -31,24 +56,50 @@ class BotManager:
 
         # ⭐(Q3) Run handle_set_type only for callback_data beginning with "SET:"
         self.bot.callback_query_handler(func=lambda callback: callback.data and callback.data.startswith("SET:"))(self.handle_set_type)
+        # digest navigation: record picker (REC:<index>) and pager (PG:<page>)
+        self.bot.callback_query_handler(func=lambda callback: callback.data and (callback.data.startswith("REC:") or callback.data.startswith("PG:")))(self.handle_nav)
 
     # ── Button helpers ──
     def _store_cb(self, txn_page_id: str, expense_type_page_id: str) -> str:
-        # ⭐(Q4) Create a short random “claim ticket” (URL-safe), store full ids server-side.
-        key = secrets.token_urlsafe(6)  # e.g., 'dQ4kQ0T8'
-        self.callback_map[key] = (txn_page_id, expense_type_page_id) # it is a tuple
-        return key
+        # ⭐(Q4) Stateless "claim ticket": pack both Notion UUIDs as raw bytes,
+        # sign with HMAC-SHA256 (truncated to 8 bytes) and base64url-encode.
+        # No server-side map → no unbounded memory growth, and buttons keep
+        # working across bot restarts. 16+16+8 bytes → 54 chars, which fits
+        # Telegram's 64-byte callback_data limit together with the "SET:" prefix.
+        txn_bytes = uuid.UUID(txn_page_id).bytes
+        if expense_type_page_id == "DELETE":
+            exp_bytes = _DELETE_SENTINEL
+        else:
+            exp_bytes = uuid.UUID(expense_type_page_id).bytes
+        payload = txn_bytes + exp_bytes
+        tag = hmac.new(CB_SECRET, payload, hashlib.sha256).digest()[:8]
+        return base64.urlsafe_b64encode(payload + tag).rstrip(b"=").decode()
+
+    def _resolve_cb(self, key: str) -> tuple[str, str] | None:
+        # Inverse of _store_cb: decode, verify the HMAC tag, unpack the ids.
+        # Returns None for anything tampered with or malformed.
+        try:
+            raw = base64.urlsafe_b64decode(key + "=" * (-len(key) % 4))
+        except (ValueError, UnicodeEncodeError):
+            return None
+        if len(raw) != 40:
+            return None
+        payload, tag = raw[:32], raw[32:]
+        if not hmac.compare_digest(hmac.new(CB_SECRET, payload, hashlib.sha256).digest()[:8], tag):
+            return None
+        txn_bytes, exp_bytes = payload[:16], payload[16:]
+        txn_page_id = str(uuid.UUID(bytes=txn_bytes))
+        exp_id = "DELETE" if exp_bytes == _DELETE_SENTINEL else str(uuid.UUID(bytes=exp_bytes))
+        return txn_page_id, exp_id
 
     def _keyboard_for(self, transaction_page_id: str) -> InlineKeyboardMarkup:
         # ⭐(Q5) Build a keyboard with one button per category.
         # The button carries only a short key (SET:<key>), not the long Notion IDs.
         keyboard = InlineKeyboardMarkup(row_width=2)
-        buttons = []
-        for name, exp_id in notion_bot.expense_type_ids.items():
-            if not exp_id:  # skip categories missing env ids
-                continue
-            callback_key = self._store_cb(transaction_page_id, exp_id)
-            buttons.append(InlineKeyboardButton(text=name, callback_data=f"SET:{callback_key}"))
+        buttons = [
+            InlineKeyboardButton(text=name, callback_data=f"SET:{self._store_cb(transaction_page_id, exp_id)}")
+            for name, exp_id in self._categories
+        ]
 
         if not buttons:
             # if we have no categories set in our notion database, then no buttons will be appending cos there's the dictionary
@@ -63,13 +114,60 @@ class BotManager:
         return keyboard
 
     def _format_record(self, rec: dict) -> str:
-        # Pretty one-record message body
-        parts = [f"<b>{html.escape(rec.get('title','(untitled)'))}</b>"]
-        if rec.get("date"):   parts.append(f"Date: {html.escape(rec['date'])}")
-        if rec.get("amount"): parts.append(f"Amount: {html.escape(str(rec['amount']))}")
+        # Pretty one-record message body (the digest's detail view)
+        parts = [f"<b>{rec.get('title','(untitled)').translate(_HTML)}</b>"]
+        if rec.get("date"):   parts.append(f"Date: {rec['date'].translate(_HTML)}")
+        if rec.get("amount"): parts.append(f"Amount: {str(rec['amount']).translate(_HTML)}")
         if rec.get("url"):    parts.append(f'<a href="{rec["url"]}">Open in Notion</a>')
         return "\n".join(parts)
 
+    # ── Digest helpers ──
+    # One /search produces ONE message: a numbered list of the batch plus a
+    # number-picker keyboard (paged, PICKER_PAGE_SIZE per page). Tapping a
+    # number swaps the keyboard for that record's category buttons. One
+    # send_message replaces N, and cleanup on the next /search is one delete.
+    def _digest_text(self, session: dict) -> str:
+        lines = [f"Found {len(session['records'])} uncategorised record(s) — tap a number to categorise:"]
+        for i, rec in enumerate(session["records"], start=1):
+            mark = session["status"].get(rec["page_id"], "")
+            title = rec.get("title", "(untitled)")
+            if len(title) > 48:  # keep 50 lines comfortably under Telegram's 4096-char cap
+                title = title[:47] + "…"
+            lines.append(f"{i}. {mark}<b>{title.translate(_HTML)}</b> — {rec['date'].translate(_HTML)} — {str(rec['amount']).translate(_HTML)}")
+        return "\n".join(lines)
+
+    def _picker_keyboard(self, session: dict) -> InlineKeyboardMarkup:
+        records = session["records"]
+        page = session["page"]
+        keyboard = InlineKeyboardMarkup(row_width=5)
+        start = page * PICKER_PAGE_SIZE
+        buttons = []
+        for i in range(start, min(start + PICKER_PAGE_SIZE, len(records))):
+            mark = session["status"].get(records[i]["page_id"], "")
+            buttons.append(InlineKeyboardButton(text=f"{mark}{i + 1}", callback_data=f"REC:{i}"))
+        keyboard.add(*buttons)
+
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton(text="◀ Prev", callback_data=f"PG:{page - 1}"))
+        if start + PICKER_PAGE_SIZE < len(records):
+            nav.append(InlineKeyboardButton(text="Next ▶", callback_data=f"PG:{page + 1}"))
+        if nav:
+            keyboard.add(*nav)
+        return keyboard
+
+    def _detail_keyboard(self, rec: dict, page: int) -> InlineKeyboardMarkup:
+        # category buttons for one record, plus a way back to the digest list
+        keyboard = self._keyboard_for(rec["page_id"])
+        keyboard.add(InlineKeyboardButton(text="↩ Back", callback_data=f"PG:{page}"))
+        return keyboard
+
+    def _render_digest(self, chat_id: int, session: dict):
+        self.bot.edit_message_text(
+            self._digest_text(session), chat_id, session["message_id"],
+            reply_markup=self._picker_keyboard(session),
+        )
+
     # ── Command handlers ──
     def start(self, message):
         self.bot.send_message(
@@ -80,51 +178,98 @@ class BotManager:
     def categorise_transactions(self, message):
         chat_id = message.chat.id
 
-        # ⭐(Q6) Clean previous batch we sent (if any)
-        for message_id in self.user_messages.get(chat_id, []):
+        # ⭐(Q6) Clean previous batch we sent (if any) — normally just the one
+        # digest message plus any stray error messages. deleteMessages takes
+        # up to 100 ids in a single API call instead of one round-trip each.
+        self.search_sessions.pop(chat_id, None)
+        stale_ids = self.user_messages.get(chat_id, ())
+        if stale_ids:
             try:
-                self.bot.delete_message(chat_id, message_id)
+                self.bot.delete_messages(chat_id, list(stale_ids))
             except Exception as e:
-                print("delete_message failed:", e)
-        self.user_messages[chat_id] = []
+                # e.g. Bot API < 7.4 — fall back to deleting one by one
+                log.warning("delete_messages failed (%s); falling back to per-message deletes", e)
+                for message_id in stale_ids:
+                    try:
+                        self.bot.delete_message(chat_id, message_id)
+                    except Exception as e:
+                        log.warning("delete_message failed: %s", e)
+        self.user_messages[chat_id] = deque(maxlen=200)
 
         # ⭐(Q6.1) Show loading while we query Notion
         loading = self.bot.send_message(chat_id, "🔎 Gathering transactions, please wait…") # 🔴 if no transactions it seems to time out, fix this error.
         self.user_messages[chat_id].append(loading.message_id) # add this loading message to the user_messages
 
-        # ⭐(Q6.2) Use the NotionManager method that RETURNS data.
-        # If you hadn't added it, you'd get AttributeError (meaning the method doesn't exist).
+        # ⭐(Q6.2) Collect the batch off the Notion generator, then turn the
+        # loading message into ONE digest with a number-picker keyboard —
+        # a single Telegram round-trip instead of one send_message per record.
         try:
-            # print('🔴 checkpoint reached')
-            records, _index = notion_bot.read_rows(limit=50)
-            print(records)
-            print(_index)
+            records = list(notion_bot.iter_rows(limit=50))
         except ValueError:
-            print('error here')
+            log.warning("ValueError while reading rows")
             self.bot.edit_message_text("✅ Nothing to categorise. ValueError encountered", chat_id, loading.message_id)
         else:
             if not records:
                 self.bot.edit_message_text("✅ Nothing to categorise.", chat_id, loading.message_id)
                 return
 
-            # turn the loading into a header
+            session = {
+                "records": records,
+                "status": {},  # page_id → "✅ " / "🗑 " once handled
+                "page": 0,
+                "message_id": loading.message_id,
+            }
+            self.search_sessions[chat_id] = session
+            self._render_digest(chat_id, session)
+
+    # ── Callback handler (digest navigation) ──
+    def handle_nav(self, c: types.CallbackQuery):
+        chat_id = c.message.chat.id
+        session = self.search_sessions.get(chat_id)
+        if not session or c.message.message_id != session["message_id"]:
+            # stale digest (bot restarted or a newer /search replaced it)
+            self.bot.answer_callback_query(c.id, "Expired — run /search again.", show_alert=False)
+            return
+
+        kind, _, arg = c.data.partition(":")
+        try:
+            n = int(arg)
+        except ValueError:
+            self.bot.answer_callback_query(c.id, "Invalid button.", show_alert=False)
+            return
+
+        if kind == "PG":
+            last_page = (len(session["records"]) - 1) // PICKER_PAGE_SIZE
+            session["page"] = max(0, min(n, last_page))
+            # answer first so the spinner always stops, then edit defensively:
+            # a double-tap re-sends the same callback_data and the identical
+            # edit gets a 400 "message is not modified" from Telegram
+            self.bot.answer_callback_query(c.id)
             try:
-                self.bot.edit_message_text(f"Found {len(records)} uncategorised record(s):", chat_id, loading.message_id)
+                self._render_digest(chat_id, session)
             except Exception as e:
-                # print(f"Exception encountered: {e}")
-                pass
-
-            # Send each record with inline buttons
-            for rec in records:
-                text = self._format_record(rec)
-                kb   = self._keyboard_for(rec["page_id"])
-                sent = self.bot.send_message(chat_id, text, reply_markup=kb)
-                self.user_messages[chat_id].append(sent.message_id) # add this message to the user_messages so we can clean it up if needed
+                log.debug("digest edit skipped: %s", e)
+        else:  # REC:<index> → show that record's details + category buttons
+            if not 0 <= n < len(session["records"]):
+                self.bot.answer_callback_query(c.id, "Invalid button.", show_alert=False)
+                return
+            rec = session["records"][n]
+            if rec["page_id"] in session["status"]:
+                self.bot.answer_callback_query(c.id, "Already handled.", show_alert=False)
+                return
+            self.bot.answer_callback_query(c.id)
+            try:
+                self.bot.edit_message_text(
+                    self._format_record(rec), chat_id, session["message_id"],
+                    reply_markup=self._detail_keyboard(rec, session["page"]),
+                )
+            except Exception as e:
+                log.debug("detail edit skipped: %s", e)
 
     # ── Callback handler (button tap) ──
     def handle_set_type(self, c: types.CallbackQuery):
         # c is a CallbackQuery (⭐ explained): c.data is our short key; c.message is the original Message with the keyboard
-        print(f"handle_set_type reached with data={getattr(c, 'data', None)}")
+        log.debug("handle_set_type reached with data=%s", getattr(c, 'data', None))
         if not (c.data and c.data.startswith("SET:")):
             self.bot.answer_callback_query(c.id, "Ignoring.", show_alert=False)
             return
@@ -134,63 +279,61 @@ class BotManager:
             self.bot.answer_callback_query(c.id, "No categories configured.", show_alert=True)
             return
 
-        # Resolve short key → full ids
-        try:
-            transaction_id, exp_type_id = self.callback_map.pop(key) # .pop looks up the key -> removes the key -> returns the value that is stored at the key, in this case it is a tuple, see _store_cb
-            # however if we get a key error when trying to remove this key from the dict, means the key no longer exists in the dictionary
-            # hence we just do nothing, but must accept the button press by the user by writing answer_callback_query otherwise the button will keep loading ('spinning' - in telegram phrasing)
-            # it IS OPTIONAL to get the data returned by .pop, but we need this data for later (see below, in order to update notion)
-        except KeyError:
-            # Common KeyError reasons:
-            # - The user tapped the same button twice (we already removed it). OR The bot restarted (our in-memory map was cleared).
+        # Resolve token → full ids (verifies the HMAC signature; no server state)
+        resolved = self._resolve_cb(key)
+        if resolved is None:
+            # Token failed to decode or the signature didn't match (tampered /
+            # truncated / signed with a different CB_SECRET).
             # IMPORTANT: Always acknowledge the tap so Telegram stops the loading spinner. can choose to send a message afterwards to update user. the text sent over is optional and not visible to users.
-
             self.bot.answer_callback_query(c.id, "Invalid/expired button.", show_alert=False)
             # call answer_callback_query on every button press, usually with show_alert=False, and then do your real UI updates by editing/deleting/sending messages.
-
             return
+        transaction_id, exp_type_id = resolved
 
         # 🔴 Delete branch
         if exp_type_id == "DELETE":
-            print("Deleted block reached.")
+            log.debug("Deleted block reached.")
             try:
                 notion_bot.delete_expense(transaction_id)
                 self.bot.answer_callback_query(c.id, "Deleted. ⛔️", show_alert=False)
-                try:
-                    # remove keyboard, then annotate
-                    self.bot.edit_message_reply_markup(c.message.chat.id, c.message.message_id, reply_markup=None)
-                except Exception as e:
-                    print(f"🔴 error encountered when editing message {e}")
-                try:
-                    self.bot.edit_message_text(c.message.text + "\n\n☑️ Deleted.", c.message.chat.id,
-                                               c.message.message_id)
-                except Exception:
-                    self.bot.send_message(c.message.chat.id, "☑️ Deleted.")
+                self._after_action(c, transaction_id, "🗑 ")
             except Exception as e:
                 self.bot.answer_callback_query(c.id, "Delete failed ❌", show_alert=False)
-                err = self.bot.send_message(c.message.chat.id, f"❌ Failed: <code>{html.escape(str(e))}</code>")
-                self.user_messages[c.message.chat.id].append(err.message_id) # basically adding the error message id to the list of messages sent so that we can delete it later
+                err = self.bot.send_message(c.message.chat.id, f"❌ Failed: <code>{str(e).translate(_HTML)}</code>")
+                # setdefault: signed buttons outlive restarts, so this chat may have no entry yet
+                self.user_messages.setdefault(c.message.chat.id, deque(maxlen=200)).append(err.message_id) # basically adding the error message id to the list of messages sent so that we can delete it later
             return
 
         # Update Notion
         try:
-            print("Updating notion block reached.")
+            log.debug("Updating notion block reached.")
             notion_bot.set_expense_type(transaction_id, exp_type_id)
             self.bot.answer_callback_query(c.id, "Updated ✅", show_alert=False)
-
-            # ⭐(Q7) First remove the keyboard (so users can’t double-tap), then annotate success.
-            # (You could instead delete the message and send a short “Categorised” line.)
-            try:
-                self.bot.edit_message_reply_markup(c.message.chat.id, c.message.message_id, reply_markup=None)
-            except Exception:
-                pass
-            try:
-                self.bot.edit_message_text(c.message.text + "\n\n✅ Categorised.", c.message.chat.id, c.message.message_id)
-            except Exception:
-                # fallback: just confirm
-                self.bot.send_message(c.message.chat.id, "✅ Categorised.")
+            self._after_action(c, transaction_id, "✅ ")
         except Exception as e:
-            print(c.message.chat.id)
+            log.warning("set_expense_type failed for chat %s: %s", c.message.chat.id, e)
             self.bot.answer_callback_query(c.id, "Update failed ❌", show_alert=False)
-            error_message = self.bot.send_message(c.message.chat.id, f"❌ Failed: <code>{html.escape(str(e))}</code>") # the notion page could have been deleted, that's why error.
-            self.user_messages[c.message.chat.id].append(error_message.message_id)  # clean up the error messages if needed
+            error_message = self.bot.send_message(c.message.chat.id, f"❌ Failed: <code>{str(e).translate(_HTML)}</code>") # the notion page could have been deleted, that's why error.
+            self.user_messages.setdefault(c.message.chat.id, deque(maxlen=200)).append(error_message.message_id)  # clean up the error messages if needed
+
+    def _after_action(self, c: types.CallbackQuery, transaction_id: str, mark: str):
+        # Back to the digest: mark the record as handled and restore the
+        # numbered list + picker. Falls back to annotating the tapped message
+        # if the session is gone (bot restart — the signed buttons still work).
+        chat_id = c.message.chat.id
+        session = self.search_sessions.get(chat_id)
+        if session and transaction_id in {rec["page_id"] for rec in session["records"]}:
+            session["status"][transaction_id] = mark
+            try:
+                self._render_digest(chat_id, session)
+            except Exception as e:
+                log.warning("🔴 error encountered when editing message %s", e)
+            return
+        try:
+            self.bot.edit_message_reply_markup(chat_id, c.message.message_id, reply_markup=None)
+        except Exception:
+            pass
+        try:
+            self.bot.edit_message_text(c.message.text + f"\n\n{mark}Done.", chat_id, c.message.message_id)
+        except Exception:
+            self.bot.send_message(chat_id, f"{mark}Done.")